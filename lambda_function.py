@@ -5,8 +5,8 @@ import string
 import logging
 import psycopg2
 import pandas as pd
-from io import StringIO
-from datetime import datetime
+from io import BytesIO
+from boto3.s3.transfer import TransferConfig
 
 # Set up logging
 logger = logging.getLogger()
@@ -18,19 +18,66 @@ s3_client = boto3.client('s3')
 # AWS S3 Configuration
 TARGET_BUCKET = "e-commerce-processed"
 
+# Parallel multipart settings for uploading cleaned data
+TRANSFER_CONFIG = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=8)
+
+# Columns and dtypes to read for each source file. Every column is read as a string, since inferred floats
+# would turn a value like 125 into '125.0' and then '1250' once the numeric fields are stripped of non-digits
+_STRING_SCHEMA = {"dtype": "string"}
+FILE_SCHEMAS = {
+    "customers.csv": _STRING_SCHEMA,
+    "customers_new.csv": {"usecols": ["CustomerKey", "Social Media Accounts"], "dtype": "string"},
+    "sales_2015.csv": _STRING_SCHEMA,
+    "sales_2016.csv": _STRING_SCHEMA,
+    "sales_2017.csv": _STRING_SCHEMA,
+    "returns.csv": _STRING_SCHEMA,
+    "products.csv": _STRING_SCHEMA,
+}
+
+# Precompiled pattern matching any non-numeric character
+_NON_DIGIT = re.compile(r'\D')
+
+# Precompiled pattern matching a value made up only of digits
+_DIGITS_ONLY = re.compile(r'\d+')
+
+# Translation table that deletes all punctuation characters
+_PUNCT_TABLE = str.maketrans('', '', string.punctuation)
+
+# Accepted HomeOwner values; anything else is treated as False
+_HOMEOWNER_MAP = {'Y': True, 'N': False, True: True, False: False}
+
+# Redshift connection, kept open and reused across warm invocations
+_REDSHIFT_CONN = None
+
 # ! Helper functions
-def clean_date(date):
-    """Clean the date field by converting from mm/dd/yyyy to yyyy-mm-dd."""
-    try:
-        # Try parsing as mm/dd/yyyy
-        parsed_date = datetime.strptime(date, "%m/%d/%Y")
-        return parsed_date.strftime("%Y-%m-%d")
-    except ValueError:
-        return "1900-01-01"  # Default date
+def parse_date_vec(series):
+    """ Parse a whole mm/dd/yyyy column into Timestamps, defaulting unparseable dates to 1900-01-01. """
+    return pd.to_datetime(series, format="%m/%d/%Y", errors='coerce').fillna(pd.Timestamp("1900-01-01"))
+
+def clean_date_vec(series):
+    """ Clean a whole date column by converting from mm/dd/yyyy to yyyy-mm-dd. """
+    return parse_date_vec(series).dt.strftime("%Y-%m-%d")
 
 def clean_numeric(value):
     """ Clean the numeric field by removing all non-numeric characters. """
-    return re.sub(r'\D', '', str(value))
+    return _NON_DIGIT.sub('', str(value))
+
+def clean_numeric_vec(series):
+    """ Vectorized clean_numeric: remove all non-numeric characters from a whole column. """
+    series = series.astype('string')
+    # Skip the regex rewrite when the column is already all digits, as most key columns are
+    if series.str.isdecimal().all():
+        return series
+    return series.str.replace(_NON_DIGIT, '', regex=True)
+
+def drop_invalid_keys(df, columns):
+    """ Drop rows whose key fields are not made up only of digits, then cast the keys to integers. """
+    valid = pd.Series(True, index=df.index)
+    for col in columns:
+        valid &= df[col].astype('string').str.fullmatch(_DIGITS_ONLY).fillna(False)
+    df.drop(df.index[~valid], inplace=True)
+    for col in columns:
+        df[col] = df[col].astype('Int64')
 
 # ! Data Cleaning Functions
 def clean_customers(df):
@@ -50,27 +97,25 @@ def clean_customers(df):
     df['Prefix'] = df['Prefix'].replace({'MrR': 'MR'})
 
     # Remove all numbers from FirstName field
-    df['FirstName'] = df['FirstName'].apply(lambda x: ''.join([i for i in x if not i.isdigit()]))
+    df['FirstName'] = df['FirstName'].str.replace(r'\d+', '', regex=True)
 
     # Remove all punctuations from the Occupation field
-    df['Occupation'] = df['Occupation'].apply(lambda x: x.translate(str.maketrans('', '', string.punctuation)))
+    df['Occupation'] = df['Occupation'].str.translate(_PUNCT_TABLE)
 
     # Split email address into parts and remove the characters before the @ symbol
-    df['EmailAddress'] = df['EmailAddress'].apply(lambda x: x.split('@')[1])
+    df['EmailAddress'] = df['EmailAddress'].str.split('@').str[1]
     
-    # Apply the clean_date function to the BirthDate field
-    df['BirthDate'] = df['BirthDate'].apply(clean_date)
+    # Convert the BirthDate field to yyyy-mm-dd
+    df['BirthDate'] = clean_date_vec(df['BirthDate'])
     
-    # Apply the clean_numeric function to the numeric fields
-    df['CustomerKey'] = df['CustomerKey'].apply(clean_numeric)
+    # Remove all non-numeric characters from the numeric fields
+    df['CustomerKey'] = clean_numeric_vec(df['CustomerKey'])
     
     # Change Home Owner field to boolean
-    df['HomeOwner'] = df['HomeOwner'].replace('Y', True).replace('N', False).fillna(False)
-    df['HomeOwner'] = df['HomeOwner'].apply(lambda x: x if x in [True, False] else False)
-    df['HomeOwner'] = df['HomeOwner'].astype(bool)
+    df['HomeOwner'] = df['HomeOwner'].map(_HOMEOWNER_MAP).fillna(False).astype(bool)
     
-    # Drop rows without a CustomerKey
-    df = df.dropna(subset=['CustomerKey'])
+    # Drop rows without a valid CustomerKey
+    drop_invalid_keys(df, ['CustomerKey'])
     
     logger.info("Data cleaning complete for customers data.")
     return df
@@ -79,14 +124,15 @@ def cleanup_customers_new(df):
     """Clean the AdventureWorks Customers New data."""
     logger.info("Cleaning social media data...")
     
-    # Remove rows where 'CustomerKey' is null
-    df = df.dropna(subset=['CustomerKey'])
+    # Remove all non-numeric characters from 'CustomerKey', then drop rows where it is null or empty
+    df['CustomerKey'] = clean_numeric_vec(df['CustomerKey'])
+    drop_invalid_keys(df, ['CustomerKey'])
     
     # Fill null values in 'Social Media Accounts' with 'NoSocialMedia'
     df['Social Media Accounts'] = df['Social Media Accounts'].fillna('NoSocialMedia')
     
-    # Split 'Social Media Accounts' into separate columns
-    social_media_df = df['Social Media Accounts'].str.get_dummies(sep=', ')    
+    # Split 'Social Media Accounts' into separate uint8 indicator columns
+    social_media_df = df['Social Media Accounts'].str.get_dummies(sep=', ').astype('uint8')
     # Concatenate with the original dataframe
     df = pd.concat([df[['CustomerKey']], social_media_df], axis=1)
     
@@ -102,21 +148,23 @@ def cleanup_sales(df):
         df.rename(columns={df.columns[-1]: "OrderQuantity"}, inplace=True)
         
     # Remove rows with missing 'OrderQuantity' values
-    df = df.dropna(subset=['OrderQuantity'])
+    df.dropna(subset=['OrderQuantity'], inplace=True)
     
     # Remove all non-numeric characters from numeric fields
-    df['OrderQuantity'] = df['OrderQuantity'].apply(clean_numeric)
-    df['ProductKey'] = df['ProductKey'].apply(clean_numeric)
-    df['CustomerKey'] = df['CustomerKey'].apply(clean_numeric)
-    df['TerritoryKey'] = df['TerritoryKey'].apply(clean_numeric)
-    df['OrderLineItem'] = df['OrderLineItem'].apply(clean_numeric)
+    df['OrderQuantity'] = clean_numeric_vec(df['OrderQuantity'])
+    df['ProductKey'] = clean_numeric_vec(df['ProductKey'])
+    df['CustomerKey'] = clean_numeric_vec(df['CustomerKey'])
+    df['TerritoryKey'] = clean_numeric_vec(df['TerritoryKey'])
+    df['OrderLineItem'] = clean_numeric_vec(df['OrderLineItem'])
     
-    # Clean date fields
-    df["OrderDate"] = df["OrderDate"].apply(clean_date)
-    df["StockDate"] = df["StockDate"].apply(clean_date)
+    # Drop rows without valid keys
+    drop_invalid_keys(df, ['ProductKey', 'CustomerKey', 'TerritoryKey'])
     
-    # Extract year from OrderDate and store in a new column
-    df["OrderYear"] = pd.to_datetime(df["OrderDate"]).dt.year
+    # Clean date fields, taking the year from the same parsed OrderDate values
+    order_dates = parse_date_vec(df["OrderDate"])
+    df["OrderDate"] = order_dates.dt.strftime("%Y-%m-%d")
+    df["StockDate"] = clean_date_vec(df["StockDate"])
+    df["OrderYear"] = order_dates.dt.year.astype('int16')
     
     logger.info("Data cleaning complete for customer sales data.")
     return df
@@ -126,15 +174,18 @@ def cleanup_returns(df):
     logger.info("Cleaning returns data...")
 
     # Clean date field
-    df["ReturnDate"] = df["ReturnDate"].apply(clean_date)
+    df["ReturnDate"] = clean_date_vec(df["ReturnDate"])
     
     # Clean numeric fields
-    df["TerritoryKey"] = df["TerritoryKey"].apply(clean_numeric)
-    df["ProductKey"] = df["ProductKey"].apply(clean_numeric)
-    df["ReturnQuantity"] = df["ReturnQuantity"].apply(clean_numeric).astype(int)
+    df["TerritoryKey"] = clean_numeric_vec(df["TerritoryKey"])
+    df["ProductKey"] = clean_numeric_vec(df["ProductKey"])
+    df["ReturnQuantity"] = pd.to_numeric(clean_numeric_vec(df["ReturnQuantity"]), errors='coerce').astype('Int64')
+    
+    # Drop rows without valid keys
+    drop_invalid_keys(df, ["TerritoryKey", "ProductKey"])
     
     # Drop rows where ReturnQuantity < 1
-    df = df[df["ReturnQuantity"] >= 1]
+    df.drop(df.index[~(df["ReturnQuantity"] >= 1).fillna(False)], inplace=True)
     
     logger.info("Data cleaning complete for returns data.")
     return df
@@ -143,59 +194,81 @@ def cleanup_products(df):
     """ Clean the AdventureWorks Products data. """
     logger.info("Cleaning products data...")
 
-    # Drop rows with missing ProductKey
-    df = df.dropna(subset=["ProductKey"])
-
-    # Clean numeric fields
-    df["ProductKey"] = df["ProductKey"].apply(clean_numeric)
-    df["ProductSubcategoryKey"] = df["ProductSubcategoryKey"].apply(clean_numeric)
-    df["ProductCost"] = df["ProductCost"].apply(clean_numeric)
-    df["ProductPrice"] = df["ProductPrice"].apply(clean_numeric)
+    # Clean numeric fields, dropping rows without a valid ProductKey
+    df["ProductKey"] = clean_numeric_vec(df["ProductKey"])
+    drop_invalid_keys(df, ["ProductKey"])
+    df["ProductSubcategoryKey"] = clean_numeric_vec(df["ProductSubcategoryKey"])
+    df["ProductCost"] = clean_numeric_vec(df["ProductCost"])
+    df["ProductPrice"] = clean_numeric_vec(df["ProductPrice"])
     
     # Fill missing values with appropriate defaults
-    df["ProductSKU"] = df["ProductSKU"].fillna("Unknown")
-    df["ProductName"] = df["ProductName"].fillna("Unknown")
-    df["ModelName"] = df["ModelName"].fillna("Unknown")
-    df["ProductDescription"] = df["ProductDescription"].fillna("No Description")
-    df["ProductColor"] = df["ProductColor"].fillna("NA")
-    df["ProductSize"] = df["ProductSize"].fillna("NA")
-    df["ProductStyle"] = df["ProductStyle"].fillna("NA")
+    df.fillna(value={
+        "ProductSKU": "Unknown",
+        "ProductName": "Unknown",
+        "ModelName": "Unknown",
+        "ProductDescription": "No Description",
+        "ProductColor": "NA",
+        "ProductSize": "NA",
+        "ProductStyle": "NA",
+    }, inplace=True)
     
     # Fill '0' in 'ProductSize' and 'ProductStyle' columns with 'NA'
-    df["ProductSize"] = df["ProductSize"].replace('0', 'NA')
-    df["ProductStyle"] = df["ProductStyle"].replace('0', 'NA')
+    df[["ProductSize", "ProductStyle"]] = df[["ProductSize", "ProductStyle"]].replace('0', 'NA')
 
     logger.info("Data cleaning complete for products data.")    
     return df
 
+# Cleanup functions for each file
+_CLEANUP_FUNCS = {
+    "customers.csv": clean_customers,
+    "customers_new.csv": cleanup_customers_new,
+    "sales_2015.csv": cleanup_sales,
+    "sales_2016.csv": cleanup_sales,
+    "sales_2017.csv": cleanup_sales,
+    "returns.csv": cleanup_returns,
+    "products.csv": cleanup_products,
+}
+
 def clean_data(df, filename):
     """ Clean the DataFrame before processing. """
     logger.info("Initializing data cleanup...")
     
-    # Cleanup functions for each file
-    cleanup_funcs = {
-        "customers.csv": clean_customers,
-        "customers_new.csv": cleanup_customers_new,
-        "sales_2015.csv": cleanup_sales,
-        "sales_2016.csv": cleanup_sales,
-        "sales_2017.csv": cleanup_sales,
-        "returns.csv": cleanup_returns,
-        "products.csv": cleanup_products,
-    }
-
     # Choose the type of processing required based on the filename
-    if filename in cleanup_funcs:
+    cleanup_func = _CLEANUP_FUNCS.get(filename)
+    if cleanup_func:
         logger.info("Cleaning data for file: %s", filename)
-        df = cleanup_funcs[filename](df)
+        df = cleanup_func(df)
     else:
         logger.info("No cleaning required for file: %s", filename)
 
     logger.info("Data cleaning complete. New shape of the dataframe: %s", df.shape)
     return df
 
+# ! Redshift helper functions
+def get_redshift_connection(dbname, host, user, password):
+    """ Return the connection kept from a previous invocation if it still answers, otherwise open a new one. """
+    global _REDSHIFT_CONN
+    if _REDSHIFT_CONN is not None and not _REDSHIFT_CONN.closed:
+        try:
+            # Idle sessions can be dropped without the connection being marked closed, so ping it first
+            curs = _REDSHIFT_CONN.cursor()
+            curs.execute("SELECT 1")
+            curs.close()
+            return _REDSHIFT_CONN
+        except psycopg2.Error:
+            logger.warning("Reused Redshift connection is no longer usable, reconnecting...")
+            _REDSHIFT_CONN.close()
+
+    logger.info("Establishing connection to Redshift database: %s", dbname)
+    _REDSHIFT_CONN = psycopg2.connect(dbname=dbname, host=host, port='5439', user=user, password=password,
+                                      keepalives=1, keepalives_idle=60, keepalives_interval=10, keepalives_count=3)
+    logger.info("Successfully connected to Redshift database: %s", dbname)
+    return _REDSHIFT_CONN
+
 # ! Lambda Handler Function to process the S3 event
 def lambda_handler(event, context):
     """ Extract data from S3, clean it, and load it into Redshift. """
+    global _REDSHIFT_CONN
     logger.info("Lambda function triggered with event: %s", event)
 
     try:
@@ -212,17 +285,9 @@ def lambda_handler(event, context):
 
         logger.info("Successfully read file from S3: %s", file_path)
 
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=file_path)
-        if "Contents" not in response:
-            raise ValueError(f"File {file_path} not found in bucket {bucket_name}")
-
-        data = obj["Body"].read().decode("ISO-8859-1")
-
-        logger.info("Successfully read file from S3: %s", file_path)
-        
-        # Convert CSV data to Pandas DataFrame
+        # Stream the CSV body straight into a Pandas DataFrame
         logger.info("Converting CSV data to DataFrame")
-        df = pd.read_csv(StringIO(data))
+        df = pd.read_csv(obj["Body"], encoding="ISO-8859-1", **FILE_SCHEMAS.get(filename, {}))
         logger.info("CSV file loaded into DataFrame. Columns: %s", df.columns.tolist())
         
         # Clean the data
@@ -239,39 +304,38 @@ def lambda_handler(event, context):
         
         # Save cleaned data to a temporary CSV file
         logger.info("Saving cleaned data to a temporary CSV file")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False, header=False)
+        csv_buffer = BytesIO()
+        df.to_csv(csv_buffer, index=False, header=False, encoding="utf-8", compression="gzip")
         csv_buffer.seek(0)
         logger.info("Cleaned data saved to temporary CSV file.")
 
         # Upload cleaned data to another S3
         logger.info("Uploading cleaned data to another S3 bucket")
-        target_filename = f"{tablename}_processed.csv"
-        s3_client.put_object(Bucket=TARGET_BUCKET, Key=target_filename, Body=csv_buffer.getvalue())
+        target_filename = f"{tablename}_processed.csv.gz"
+        s3_client.upload_fileobj(csv_buffer, TARGET_BUCKET, target_filename, Config=TRANSFER_CONFIG)
         logger.info("Cleaned data uploaded to S3 bucket: %s", TARGET_BUCKET)
         
-        # Establish connection to Redshift
-        logger.info("Establishing connection to Redshift database: %s", dbname)
-        connection = psycopg2.connect(dbname=dbname, host=host, port='5439', user=user, password=password)
+        # Establish connection to Redshift, reusing the one from a previous invocation if it still answers
+        connection = get_redshift_connection(dbname, host, user, password)
         curs = connection.cursor()
-        logger.info("Successfully connected to Redshift database: %s", dbname)
         
         # Upload cleaned data to Redshift
+        # Redshift's COPY does not accept FROM STDIN, so the data has to be staged in S3 first
         copy_query = """
             COPY {}
             FROM 's3://{}/{}'
             IAM_ROLE 'your-iam-role-arn'
             FORMAT AS CSV
-            DELIMITER ',';
+            DELIMITER ','
+            GZIP;
         """.format(tablename, TARGET_BUCKET, target_filename)
         
         logger.info("Executing Redshift COPY command...")
         curs.execute(copy_query)
         connection.commit()
         
-        # Close connection
+        # Close the cursor but keep the connection open for the next invocation
         curs.close()
-        connection.close()
         
         logger.info("Data successfully loaded into Redshift table: %s", tablename)
         
@@ -282,6 +346,15 @@ def lambda_handler(event, context):
     
     except Exception as e:
         logger.error("Error occurred: %s", str(e), exc_info=True)
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            # Drop the broken connection so the next invocation reconnects
+            _REDSHIFT_CONN = None
+        elif _REDSHIFT_CONN is not None and not _REDSHIFT_CONN.closed:
+            # Discard any failed transaction so the connection stays usable
+            try:
+                _REDSHIFT_CONN.rollback()
+            except psycopg2.Error:
+                _REDSHIFT_CONN = None
         return {
             "statusCode": 500,
             "body": f"Error processing data: {str(e)}"